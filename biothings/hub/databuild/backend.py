@@ -98,6 +98,11 @@ class TargetDocBackend(DocBackendBase):
                                          get_timestamp(), get_random_string()).lower()
 
     def post_merge(self):
+        """
+        Called once data is merged. If target needs secondary indexes,
+        this is the place to create them rather than prepare(), so they
+        aren't maintained for each and every merged document.
+        """
         pass
 
 class SourceDocMongoBackend(SourceDocBackendBase):
@@ -6,6 +6,7 @@ import importlib
 import pickle
 from datetime import datetime
 from pprint import pformat
+from logging import DEBUG
 import asyncio
 from functools import partial
 import glob, random
@@ -38,6 +39,10 @@ class ResumeException(Exception):
 class DataBuilder(object):
 
     keep_archive = 10 # number of archived collection to keep. Oldest get dropped first.
+    # merge sources not needing any document processing (no mapper, no cleaner)
+    # directly within MongoDB, using $merge (MongoDB >= 4.2, source and target
+    # databases must be on the same server)
+    server_side_merge = False
 
     def __init__(self, build_name, source_backend, target_backend, log_folder,
                  doc_root_key="root", mappers=[], default_mapper_class=TransparentMapper,
@@ -78,6 +83,7 @@ class DataBuilder(object):
         self.src_meta = {} # sources involved in this build (includes versions)
         self.stats = {} # can be customized
         self.mapping = {} # ES mapping (merged from src_master's docs)
+        self.defined_root_sources = None # resolved root sources (set), computed when merging
 
         for mapper in mappers + [default_mapper_class()]:
             self.mappers[mapper.name] = mapper
@@ -214,17 +220,18 @@ class DataBuilder(object):
         The key used in this dict the target_name. Then, any operation
         acting on this target_name is registered in a "jobs" list.
         """
-        assert self.build_config, "build_config needs to be specified first"
+        # build_config is fetched from db each time it's accessed, do it once
+        build_config = self.build_config
+        assert build_config, "build_config needs to be specified first"
         # get it from source_backend, kind of weird...
         src_build = self.source_backend.build
-        src_build_config = self.source_backend.build_config
-        all_sources = self.build_config.get("sources",[])
+        all_sources = build_config.get("sources",[])
         target_name = "%s" % self.target_backend.target_name
         build_info = {
                 '_id' : target_name,
                 'target_backend': self.target_backend.name,
                 'target_name': target_name,
-                'build_config': self.build_config,
+                'build_config': build_config,
                 # these are all the sources required to build target
                 # (not just the ones being processed, those are registered in jobs
                 'sources' : all_sources, 
@@ -246,19 +253,29 @@ class DataBuilder(object):
             build_info.update(extra["build"])
         if "job" in extra:
             job_info.update(extra["job"])
-        # create a new build entry in "build" dict if none exists
-        build = src_build.find_one({'_id': target_name})
+        if init:
+            # init timer for this step
+            self.ti = time.time()
+            # create a new build entry if none exists (first record for target_name,
+            # keep a timestamp) and register the new job, in one single query
+            build_info.pop("_id")
+            build_info["started_at"] = datetime.fromtimestamp(self.t0)
+            src_build.update_one({'_id': target_name},
+                    {"$setOnInsert": build_info, "$push": {'jobs': job_info}},
+                    upsert=True)
+            return
+        # only fetch what's going to be merged/updated
+        fields = dict([(k,1) for k in build_info])
+        fields["jobs"] = 1
+        build = src_build.find_one({'_id': target_name},fields)
         if not build:
             # first record for target_name, keep a timestamp
             build_info["started_at"] = datetime.fromtimestamp(self.t0)
             build_info["jobs"] = []
             src_build.insert_one(build_info)
-        if init:
-            # init timer for this step
-            self.ti = time.time()
-            src_build.update({'_id': target_name}, {"$push": {'jobs': job_info}})
-            # now refresh/sync
-            build = src_build.find_one({'_id': target_name})
+        elif "__REPLACE__" in build_info:
+            build_info.pop("__REPLACE__")
+            src_build.replace_one({"_id" : target_name}, build_info)
         else:
             # merge extra at root level
             # (to keep building data...) and update the last one
@@ -284,7 +301,11 @@ class DataBuilder(object):
                             target[k] = v
                 return target
             build = merge_build_info(build,build_info)
-            src_build.replace_one({"_id" : build["_id"]}, build)
+            # only update what's changed: build_info's keys and the last job
+            upd = dict([(k,build[k]) for k in build_info if k != "_id"])
+            if build["jobs"]:
+                upd["jobs.%d" % (len(build["jobs"]) - 1)] = build["jobs"][-1]
+            src_build.update_one({"_id" : target_name}, {"$set" : upd})
 
     def clean_old_collections(self):
         # use target_name is given, otherwise build name will be used 
@@ -310,6 +331,13 @@ class DataBuilder(object):
     def generate_document_query(self, src_name):
         return None
 
+    def generate_document_projection(self, src_name):
+        """
+        Return a projection (mongo notation) restricting which fields
+        are fetched from source src_name and merged. None means all fields.
+        """
+        return None
+
     def get_root_document_sources(self):
         root_srcs = self.build_config.get(self.doc_root_key,[]) or []
         # check for "not this resource" and adjust the list
@@ -368,9 +396,13 @@ class DataBuilder(object):
         """
         mapping = {}
         src_master = self.source_backend.master
-        for collection in self.build_config['sources']:
-            meta = src_master.find_one({"_id" : collection})
-            if 'mapping' in meta and meta["mapping"]:
+        srcs = self.build_config['sources']
+        # fetch all mappings at once, but merge them following build config's order
+        metas = dict([(meta["_id"],meta) for meta in \
+                src_master.find({"_id" : {"$in" : srcs}},{"mapping" : 1})])
+        for collection in srcs:
+            meta = metas.get(collection) or {}
+            if meta.get("mapping"):
                 mapping = merge_struct(mapping,meta['mapping'])
             else:
                 raise BuilderException('"%s" has no mapping data' % collection)
@@ -406,8 +438,11 @@ class DataBuilder(object):
         """
         if type(sources) == str:
             sources = [sources]
+        if not sources:
+            return []
         src_db = mongo.get_src_db()
         cols = src_db.collection_names()
+        cols_set = set(cols)
         masters = self.source_backend.get_src_master_docs()
         found = []
         for src in sources:
@@ -419,6 +454,11 @@ class DataBuilder(object):
             search = src
             if master["_id"] != master["name"]:
                 search = master["name"]
+            if re.escape(search) == search:
+                # plain name, no need to match all collections
+                if search in cols_set:
+                    found.append(search)
+                continue
             # restrict pattern to minimal match
             pat = re.compile("^%s$" % search)
             for col in cols:
@@ -506,9 +546,6 @@ class DataBuilder(object):
                             build_version = self.get_build_version()
                             if "." in build_version:
                                 raise BuilderException("Can't use '.' in build version '%s', it's reserved for minor versions" % build_version)
-                            # get original start dt
-                            src_build = self.source_backend.build
-                            build = src_build.find_one({'_id': target_name})
                             _meta = {
                                     "src_version" : self.src_versions,
                                     "src" : self.src_meta,
@@ -554,7 +591,7 @@ class DataBuilder(object):
         try:
             init and self.init_mapper(mapper_name)
             mapper = self.mappers[mapper_name]
-            self.logger.info("Found mapper '%s' for source '%s'" % (mapper,src_name))
+            self.logger.info("Found mapper '%s' for source '%s'",mapper,src_name)
             return mapper
         except KeyError:
             raise BuilderException("Found mapper named '%s' but no mapper associated" % mapper_name)
@@ -579,9 +616,11 @@ class DataBuilder(object):
         self.mapping = {}
         # try to identify root document sources amongst the list to first
         # process them (if any)
-        defined_root_sources = self.get_root_document_sources()
-        root_sources = list(set(source_names).intersection(set(defined_root_sources)))
-        other_sources = list(set(source_names).difference(set(root_sources)))
+        # resolving root sources involves db queries, do it once for the whole merge
+        self.defined_root_sources = frozenset(self.get_root_document_sources())
+        defined_root_sources = self.defined_root_sources
+        root_sources = [src for src in source_names if src in defined_root_sources]
+        other_sources = [src for src in source_names if not src in defined_root_sources]
         # got root doc sources but not part of the merge ? that's weird...
         if defined_root_sources and not root_sources:
             self.logger.warning("Root document sources found (%s) but not part of the merge..." % defined_root_sources)
@@ -683,12 +722,15 @@ class DataBuilder(object):
         # it's actually not optional
         assert job_manager
         _query = self.generate_document_query(src_name)
+        _projection = self.generate_document_projection(src_name)
         # Note: no need to check if there's an existing document with _id (we want to merge only with an existing document)
         # if the document doesn't exist then the update() call will silently fail.
         # That being said... if no root documents, then there won't be any previously inserted
         # documents, and this update() would just do nothing. So if no root docs, then upsert
         # (update or insert, but do something)
-        defined_root_sources = self.get_root_document_sources()
+        defined_root_sources = self.defined_root_sources
+        if defined_root_sources is None:
+            defined_root_sources = frozenset(self.get_root_document_sources())
         upsert = not defined_root_sources or src_name in defined_root_sources
         if not upsert:
             self.logger.debug("Documents from source '%s' will be stored only if a previous document exists with same _id" % src_name)
@@ -720,34 +762,58 @@ class DataBuilder(object):
             id_provider = ids and iter_n(ids,int(batch_size/100)) or id_feeder(self.source_backend[src_name],
                     batch_size=id_batch_size,logger=self.logger)
 
-        src_master = self.source_backend.master
-        meta = src_master.find_one({"_id":src_name}) or {}
+        # master docs are cached by source backend, no need to query src_master
+        meta = self.source_backend.get_src_master_docs().get(src_name) or {}
         merger = meta.get("merger","upsert")
         self.logger.info("Documents from source '%s' will be merged using %s" % (src_name,merger))
+        # same mapper for all batches
+        mapper = self.get_mapper_for_source(src_name,init=False)
 
         doc_cleaner = self.document_cleaner(src_name)
+        if self.server_side_merge and ids is None and upsert and merger == "upsert" \
+                and doc_cleaner is None and type(mapper) is TransparentMapper:
+            # nothing to do on documents, they can be copied as-is (exact type
+            # checked, a sub-class could override process())
+            self.logger.info("Merging '%s' server-side" % src_name)
+            pinfo = self.get_pinfo()
+            pinfo["step"] = src_name
+            pinfo["description"] = "server-side merge"
+            job = yield from job_manager.defer_to_thread(pinfo,
+                    partial(self.merge_source_server_side,src_name,_query,_projection,total))
+            cnt = yield from job
+            return {"%s" % src_name : cnt}
+
+        # identifies this merge run, so workers don't reuse mappers loaded for another one
+        run_id = (self.target_backend.target_name,self.t0)
+        # common to all batches, only description changes
+        base_pinfo = self.get_pinfo()
+        base_pinfo["step"] = src_name
         for big_doc_ids in id_provider:
             for doc_ids in iter_n(big_doc_ids,batch_size):
                 # try to put some async here to give control back
-                # (but everybody knows it's a blocking call: doc_feeder)
-                yield from asyncio.sleep(0.1)
+                # (but everybody knows it's a blocking call: doc_feeder).
+                # No need to pause longer, defer_to_process() blocks until
+                # the job manager can actually run the batch, so reading _ids
+                # and merging batches in workers already overlap
+                yield from asyncio.sleep(0.0)
                 cnt += len(doc_ids)
-                pinfo = self.get_pinfo()
-                pinfo["step"] = src_name
-                pinfo["description"] = "#%d/%d (%.1f%%)" % (bnum,btotal,(cnt/total*100))
-                self.logger.info("Creating merger job #%d/%d, to process '%s' %d/%d (%.1f%%)" % \
-                        (bnum,btotal,src_name,cnt,total,(cnt/total*100.)))
+                pinfo = dict(base_pinfo,description="#%d/%d (%.1f%%)" % (bnum,btotal,(cnt/total*100)))
+                # lazy formatting, only done if record is actually emitted
+                self.logger.info("Creating merger job #%d/%d, to process '%s' %d/%d (%.1f%%)",
+                        bnum,btotal,src_name,cnt,total,(cnt/total*100.))
                 job = yield from job_manager.defer_to_process(
                         pinfo,
                         partial(merger_worker,
                             self.source_backend[src_name].name,
                             self.target_backend.target_name,
                             doc_ids,
-                            self.get_mapper_for_source(src_name,init=False),
+                            mapper,
                             doc_cleaner,
                             upsert,
                             merger,
-                            bnum))
+                            bnum,
+                            _projection,
+                            run_id))
                 def batch_merged(f,batch_num):
                     nonlocal got_error
                     if type(f.result()) != int:
@@ -775,23 +841,93 @@ class DataBuilder(object):
         else:
             return {"%s" % src_name : cnt}
 
+    def merge_source_server_side(self, src_name, query=None, projection=None, total=None):
+        """
+        Merge (upsert) documents from source src_name into target collection
+        using a $merge aggregation stage, documents never leave the server.
+        Requires MongoDB >= 4.2, with source and target databases hosted on
+        the same server. Return the number of merged documents. When there's no
+        query, that's the whole source: total (source's count, if already known)
+        is returned instead of counting again.
+        """
+        src_col = self.source_backend[src_name]
+        tgt_col = self.target_backend.target_collection
+        pipeline = [{"$match" : query or {}}]
+        if projection:
+            pipeline.append({"$project" : projection})
+        pipeline.append(
+            {"$merge" : {"into" : {"db" : tgt_col.database.name, "coll" : tgt_col.name},
+                         "on" : "_id",
+                         "whenMatched" : "merge",
+                         "whenNotMatched" : "insert"}})
+        src_col.aggregate(pipeline,allowDiskUse=True)
+        if query:
+            return src_col.count_documents(query)
+        elif total is None:
+            return src_col.estimated_document_count()
+        return total
+
     def post_merge(self, source_names, batch_size, job_manager):
         pass
 
 
 from biothings.utils.backend import DocMongoBackend
 
-def merger_worker(col_name,dest_name,ids,mapper,cleaner,upsert,merger,batch_num):
+# mappers already loaded in this (worker) process, per merge run
+_loaded_mappers = {}
+# number of merge runs to keep mappers for (runs can be concurrent)
+_max_loaded_runs = 2
+
+def get_loaded_mapper(mapper,run_id=None):
+    """
+    Return a loaded version of mapper. Mappers are sent (pickled) to workers
+    for each batch and would load their data each time, so keep the loaded
+    ones during a merge run, identified by run_id. Mapping data may have changed
+    between two runs (eg. source re-uploaded), a new run always load mappers again.
+    If run_id is None, mapper is loaded and not kept.
+    Memory trade-off: loaded mappers (id maps can be several hundred MB) are
+    kept in each worker process after the merge is over, for the last
+    _max_loaded_runs runs that worker has seen. They're only freed when newer
+    runs evict them or when the process queue is recycled (JobManager.recycle_process_queue(),
+    done automatically when max_memory_usage is reached and auto_recycle is on).
+    """
+    if run_id is None:
+        mapper.load()
+        return mapper
+    mappers = _loaded_mappers.get(run_id)
+    if mappers is None:
+        # new run, forget oldest ones
+        while len(_loaded_mappers) >= _max_loaded_runs:
+            _loaded_mappers.pop(next(iter(_loaded_mappers)))
+        mappers = _loaded_mappers[run_id] = {}
+    if not mapper.name in mappers:
+        mapper.load()
+        mappers[mapper.name] = mapper
+    return mappers[mapper.name]
+
+def merger_worker(col_name,dest_name,ids,mapper,cleaner,upsert,merger,batch_num,projection=None,run_id=None):
     try:
         src = mongo.get_src_db()
         tgt = mongo.get_target_db()
         col = src[col_name]
         dest = DocMongoBackend(tgt,tgt[dest_name])
-        cur = doc_feeder(col, step=len(ids), inbatch=False, query={'_id': {'$in': ids}})
+        # plain cursor, all docs consumed right away. doc_feeder() would
+        # issue an extra count() query and a python-level generator per batch
+        docs = list(col.find({'_id': {'$in': ids}},projection).batch_size(len(ids)))
+        if not docs:
+            # nothing to merge, don't even bother loading the mapper
+            return 0
         if cleaner:
-            cur = map(cleaner,cur)
-        mapper.load()
-        docs = [d for d in mapper.process(cur)]
+            docs = map(cleaner,docs)
+        mapper = get_loaded_mapper(mapper,run_id)
+        docs = mapper.process(docs)
+        # mappers usually return a generator, need a list to count/re-use docs.
+        # Default TransparentMapper returns docs as-is, no need to copy it again
+        if type(docs) is not list:
+            docs = list(docs)
+        if not docs:
+            # all discarded by mapper
+            return 0
         if merger == "merge_struct":
             stored_docs = dest.mget_from_ids([d["_id"] for d in docs])
             ddocs = dict([(d["_id"],d) for d in docs])
@@ -933,7 +1069,8 @@ class BuilderManager(BaseManager):
 
     def list_merge(self,build_config=None,only_archived=False):
         q = self.get_query_for_list_merge(only_archived)
-        docs = get_src_build().find(q)
+        # only build config's name is needed, don't fetch whole build docs
+        docs = get_src_build().find(q,{"build_config.name":1})
         by_confs = {}
         for d in docs:
             by_confs.setdefault(d["build_config"]["name"],[]).append(d["_id"])
@@ -1137,7 +1274,9 @@ class BuilderManager(BaseManager):
         self.configure()
 
     def save_mapping(self, name, mapping=None, dest="build", mode="mapping"):
-        logging.debug("Saving mapping for build '%s' destination='%s':\n%s" % (name,dest,pformat(mapping)))
+        # pformat() is costly, only when it's going to be logged
+        if logging.isEnabledFor(DEBUG):
+            logging.debug("Saving mapping for build '%s' destination='%s':\n%s",name,dest,pformat(mapping))
         src_build = get_src_build()
         m = src_build.find_one({"_id":name})
         assert m, "Can't find build document for '%s'" % name
@@ -298,7 +298,8 @@ class SourceManager(BaseSourceManager):
         return self.get_sources(id=name,debug=debug,detailed=True)
 
     def save_mapping(self, name, mapping=None, dest="master", mode="mapping"):
-        logging.debug("Saving mapping for source '%s' destination='%s':\n%s" % (name,dest,pformat(mapping)))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Saving mapping for source '%s' destination='%s':\n%s",name,dest,pformat(mapping))
         # either given a fully qualified source or just sub-source
         try:
             subsrc = name.split(".")[1]
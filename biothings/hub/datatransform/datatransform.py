@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 
 from .histogram import Histogram
 from biothings.utils.common import iter_n
@@ -10,7 +11,18 @@ class IDStruct(object):
     IDStruct - id structure for use with the DataTransform classes.  The basic idea
     is to provide a structure that provides a list of (original_id, current_id)
     pairs.
+    Pairs are stored as adjacency dicts in both directions (forward: original_id
+    to current_ids, inverse: current_id to original_ids). Adjacent ids are kept
+    as dict keys (values unused): constant time membership, no duplicates, and
+    insertion order is kept.
+    Plain python dicts and __slots__ are intentional: instances are small and
+    numerous (one per batch and edge lookup) and only need one-hop lookups, a
+    graph library (networkx,...) would only add per-call overhead. Graph
+    algorithms are only needed on the configuration graph (see DataTransformMDB).
     """
+
+    __slots__ = ("forward", "inverse")
+
     def __init__(self, field=None, doc_lst=None):
         """
         Initialize the structure
@@ -22,17 +34,33 @@ class IDStruct(object):
         if field and doc_lst:
             self._init_strct(field, doc_lst)
 
+    def _add_is_default(self):
+        """False if add() is customized (sub-class), pairs must then go through it"""
+        return type(self).add is IDStruct.add
+
     def _init_strct(self, field, doc_lst):
         """initialze _id_tuple_lst"""
+        if not self._add_is_default():
+            for doc in doc_lst:
+                value = nested_lookup(doc, field)
+                if value:
+                    self.add(value, value)
+            return
+        # only (id, id) pairs to register, fill adjacency dicts directly
+        forward = self.forward
+        inverse = self.inverse
         for doc in doc_lst:
             value = nested_lookup(doc, field)
             if value:
-                self.add(value, value)
+                ids = dict.fromkeys(type(value) in (list,tuple) and value or [value])
+                for v in ids:
+                    forward.setdefault(v,{}).update(ids)
+                    inverse.setdefault(v,{}).update(ids)
 
     def __iter__(self):
         """iterator overload function"""
-        for k in self.forward.keys():
-            for f in self.forward[k]:
+        for k,rights in self.forward.items():
+            for f in rights:
                 yield k, f
 
     def add(self, left, right):
@@ -41,66 +69,64 @@ class IDStruct(object):
             return  # identifiers cannot be None
         if self.lookup(left, right):
             return  # tuple already in the list
-        # ensure it's hashable
         if not type(left) in [list,tuple]:
             left = [left]
         if not type(right) in [list,tuple]:
             right = [right]
-        if type(left) == list:
-            left = tuple(left)
-        if type(right) == list:
-            right = tuple(right)
         for v in left:
-            if v not in self.forward.keys():
-                self.forward[v] = right
-            else:
-                self.forward[v] = self.forward[v] + right
+            self.forward.setdefault(v,{}).update(dict.fromkeys(right))
         for v in right:
-            if v not in self.inverse.keys():
-                self.inverse[v] = left
-            else:
-                self.inverse[v] = self.inverse[v] + left
+            self.inverse.setdefault(v,{}).update(dict.fromkeys(left))
 
     def __iadd__(self, other):
         """object += additional, which combines lists"""
         if not isinstance(other, IDStruct):
             raise TypeError("other is not of type IDStruct")
-        for (left, right) in other:
-            self.add(left, right)
+        if not self._add_is_default():
+            for (left, right) in other:
+                self.add(left, right)
+            return self
+        # merge adjacency dicts at once
+        for k,rights in other.forward.items():
+            self.forward.setdefault(k,{}).update(rights)
+        for k,lefts in other.inverse.items():
+            self.inverse.setdefault(k,{}).update(lefts)
         return self
 
     def __len__(self):
         """Return the number of keys (forward direction)"""
-        return len(self.forward.keys())
+        return len(self.forward)
 
     def __str__(self):
         """convert to a string, useful for debugging"""
-        lst = []
-        for k in self.forward.keys():
-            for f in self.forward[k]:
-                lst.append((k, f))
-        return str(lst)
+        # same output as str(list(self)), without the intermediate list
+        return "[%s]" % ", ".join(repr(pair) for pair in self)
 
     @property
     def id_lst(self):
         """Build up a list of current ids"""
-        id_set = set()
-        for k in self.forward.keys():
-            for f in self.forward[k]:
-                id_set.add(f)
-        return list(id_set)
+        # inverse's keys are all current ids, kept up-to-date when adding pairs
+        return list(self.inverse)
 
     def lookup(self, left, right):
         """Find if a (left, right) pair is already in the list"""
-        for r in self.find_left(left):
-            if right == r:
-                return True
+        if not left:
+            return False
+        if not type(left) in (list,tuple):
+            left = [left]
+        try:
+            for l in left:
+                if right in self.forward.get(l,()):
+                    return True
+        except TypeError:
+            # unhashable (list) right can't be registered
+            pass
         return False
 
     def side(self,_id,where):
         if type(_id) == list:
             _id = tuple(_id)
-        return _id in where.keys()
+        return _id in where
 
     def left(self, id):
         """Determine if the id (left, _) is registered"""
@@ -111,10 +137,21 @@ class IDStruct(object):
             return
         if not type(ids) in (list,tuple):
             ids = [ids]
+        if len(ids) == 1:
+            # adjacent ids are unique, no need to track what's been yielded
+            sub = where.get(ids[0])
+            if sub:
+                yield from sub
+            return
+        # an id can be reached from several ids, yield it only once
+        seen = set()
         for id in ids:
-            if id in where.keys():
-                for i in where[id]:
-                    yield i
+            sub = where.get(id)
+            if sub:
+                for i in sub:
+                    if not i in seen:
+                        seen.add(i)
+                        yield i
 
     def find_left(self, ids):
         return self.find(self.forward,ids)
@@ -261,7 +298,7 @@ class DataTransform(object):
         :return:
         """
         value = doc
-        keys = field.split('.')
+        keys = _split_field(field)
         try:
             for k in keys:
                 value = value[k]
@@ -358,6 +395,16 @@ class RegExEdge(DataTransformEdge):
         return res_id_strct
 
 
+@lru_cache(maxsize=128)
+def _split_field(field):
+    """
+    Split a period (.) delimited field into a tuple of keys. Lookups
+    are done per document with only a handful of distinct fields, so
+    the result is cached.
+    """
+    return tuple(field.split('.'))
+
+
 def nested_lookup(doc, field):
     """
     Performs a nested lookup of doc using a period (.) delimited
@@ -367,7 +414,7 @@ def nested_lookup(doc, field):
     :return:
     """
     value = doc
-    keys = field.split('.')
+    keys = _split_field(field)
     try:
         for k in keys:
             if type(value) in [list,tuple]:
@@ -153,20 +153,20 @@ class DataTransformAPI(DataTransform):
         :param qr: querymany results
         :return:
         """
-        self.logger.debug("QueryMany Structure:  {}".format(qr))
+        self.logger.debug("QueryMany Structure:  %s", qr)
         qm_struct = {}
         for q in qr['out']:
             query = q['query']
             val = self._parse_h(q)
             if val:
-                if query not in qm_struct.keys():
+                if query not in qm_struct:
                     qm_struct[query] = [val]
                 else:
                     self.one_to_many_cnt += 1
                     qm_struct[query] = qm_struct[query] + [val]
-        self.logger.debug("parse_querymany num qm_struct keys: {}".format(len(qm_struct.keys())))
+        self.logger.debug("parse_querymany num qm_struct keys: %s", len(qm_struct))
         self.logger.info("parse_querymany running one_to_many_cnt: {}".format(self.one_to_many_cnt))
-        self.logger.debug("parse_querymany qm_struct: {}".format(qm_struct.keys()))
+        self.logger.debug("parse_querymany qm_struct: %s", qm_struct.keys())
         return qm_struct
 
     def _parse_h(self, h):
@@ -196,8 +196,9 @@ class DataTransformAPI(DataTransform):
             new_doc = None
             for input_type in self.input_types:
                 # doc[input_type[1]] must be typed to a string because qm_struct.keys are always strings
-                if DataTransformAPI._nested_lookup(doc, input_type[1]) in qm_struct.keys():
-                    for key in qm_struct[DataTransformAPI._nested_lookup(doc, input_type[1])]:
+                value = DataTransformAPI._nested_lookup(doc, input_type[1])
+                if value in qm_struct:
+                    for key in qm_struct[value]:
                         new_doc = copy.deepcopy(doc)
                         new_doc['_id'] = key
                         res_lst.append(new_doc)
@@ -348,7 +349,7 @@ class BiothingsAPIEdge(DataTransformEdge):
         :param qr: querymany results
         :return:
         """
-        self.logger.debug("QueryMany Structure:  {}".format(qr))
+        self.logger.debug("QueryMany Structure:  %s", qr)
         qm_struct = IDStruct()
         for q in qr['out']:
             query = q['query']
@@ -2,9 +2,11 @@ import config, biothings
 biothings.config_for_app(config)
 
 from biothings.hub.datatransform import DataTransformMDB as KeyLookup
+from biothings.hub.datatransform import IDStruct
 from biothings.tests.keylookup_graphs import graph_simple, \
     graph_weights, graph_one2many, graph_invalid, graph_mix, \
     graph_mychem, graph_regex
+import time
 import unittest
 import biothings.utils.mongo as mongo
 
@@ -458,3 +460,73 @@ class TestDataTransform(unittest.TestCase):
 
     #    res = next(res_lst)
     #    self.assertEqual(res['_id'], 'b:f1')
+
+
+class TestIDStruct(unittest.TestCase):
+
+    # max time (seconds) allowed for test_scale
+    scale_time_limit = 5.0
+
+    def test_init(self):
+        """
+        Initial (id, id) pairs are built from documents field
+        """
+        doc_lst = [{'_id': 'a:1'}, {'_id': ['a:2', 'a:3']}, {'other': 'a:4'}, {'_id': 'a:1'}]
+        ids = IDStruct('_id', doc_lst)
+        self.assertEqual(list(ids), [('a:1', 'a:1'), ('a:2', 'a:2'), ('a:2', 'a:3'),
+                                     ('a:3', 'a:2'), ('a:3', 'a:3')])
+        self.assertEqual(len(ids), 3)
+        self.assertEqual(sorted(ids.id_lst), ['a:1', 'a:2', 'a:3'])
+
+    def test_add_lookup(self):
+        ids = IDStruct()
+        ids.add('a:1', 'b:1')
+        ids.add('a:1', 'b:1')
+        ids.add(['a:2', 'a:3'], 'b:1')
+        ids.add('a:1', None)
+        self.assertEqual(str(ids), str([('a:1', 'b:1'), ('a:2', 'b:1'), ('a:3', 'b:1')]))
+        self.assertTrue(ids.lookup('a:1', 'b:1'))
+        self.assertTrue(ids.lookup(['a:4', 'a:2'], 'b:1'))
+        self.assertFalse(ids.lookup('a:1', 'b:2'))
+        self.assertFalse(ids.lookup('a:1', ['b:1']))
+        self.assertTrue(ids.left('a:3'))
+        self.assertFalse(ids.left('b:1'))
+        self.assertTrue(ids.right('b:1'))
+        self.assertEqual(list(ids.find_left('a:1')), ['b:1'])
+        self.assertEqual(list(ids.find_right('b:1')), ['a:1', 'a:2', 'a:3'])
+        # reached twice, returned once
+        self.assertEqual(list(ids.find_left(['a:1', 'a:2'])), ['b:1'])
+        self.assertEqual(ids.id_lst, ['b:1'])
+
+    def test_iadd(self):
+        ids = IDStruct()
+        ids.add('a:1', 'b:1')
+        self.assertEqual(ids.id_lst, ['b:1'])
+        other = IDStruct()
+        other.add('a:1', 'b:2')
+        other.add('a:2', 'b:1')
+        ids += other
+        self.assertEqual(list(ids), [('a:1', 'b:1'), ('a:1', 'b:2'), ('a:2', 'b:1')])
+        self.assertEqual(sorted(ids.id_lst), ['b:1', 'b:2'])
+        self.assertEqual(list(ids.find_right('b:1')), ['a:1', 'a:2'])
+        with self.assertRaises(TypeError):
+            ids += [('a:3', 'b:3')]
+
+    def test_scale(self):
+        """
+        Build and query a 10k pairs structure, guards against performance regressions
+        """
+        n = 10000
+        t0 = time.perf_counter()
+        ids = IDStruct('_id', [{'_id': 'a:%d' % i} for i in range(n)])
+        res = IDStruct()
+        for i in range(n):
+            res.add('a:%d' % i, 'b:%d' % (i % 100))
+        ids += res
+        self.assertEqual(len(ids), n)
+        self.assertEqual(len(res.id_lst), 100)
+        self.assertEqual(len(ids.id_lst), n + 100)
+        self.assertEqual(len(list(ids)), 2 * n)
+        for i in range(n):
+            self.assertTrue(ids.lookup('a:%d' % i, 'b:%d' % (i % 100)))
+        self.assertLess(time.perf_counter() - t0, self.scale_time_limit)
@@ -134,25 +134,25 @@ class DocMongoBackend(DocBackendBase):
             import pickle
             pickle.dump(e,open("err","wb"))
 
-    def update(self, docs, upsert=False):
+    def update(self, docs, upsert=False, ordered=False):
         '''if id does not exist in the target_collection,
-            the update will be ignored except if upsert is True
+            the update will be ignored except if upsert is True.
+            Documents are matched on _id only, so each update is
+            index-backed (sub-classes should keep it that way).
+            Updates are sent unordered by default (server can apply them
+            in parallel, an error doesn't stop the rest of the batch),
+            pymongo takes care of splitting according to server's limits.
         '''
-        bulk = self.target_collection.initialize_ordered_bulk_op()
-        at_least_one = False
-        for doc in docs:
-            at_least_one = True
-            op = bulk.find({'_id':doc["_id"]})
-            if upsert:
-                op = op.upsert()
-            op.update({"$set":doc})
-        if at_least_one:
-            res = bulk.execute()
+        from pymongo import UpdateOne
+        ops = [UpdateOne({'_id':doc["_id"]},{"$set":doc},upsert=upsert) for doc in docs]
+        if ops:
+            res = self.target_collection.bulk_write(ops,ordered=ordered,
+                                                    bypass_document_validation=True)
             # if doc is the same, it'll be matched but not modified.
             # but for us, it's been processed. if upserted, then it can't be matched
             # before (so matched cound doesn't include upserted). finally, it's only update
             # ops, so don't count nInserted and nRemoved
-            return res["nMatched"] + res["nUpserted"]
+            return res.matched_count + res.upserted_count
         else:
             return 0
 